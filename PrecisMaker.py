@@ -16,8 +16,10 @@ Table of Contents
 3.0 Constructing Our Data
 4.0 Running the Algorithm
 5.0 Generating XML Output
-6.0 Acknowledgements
-7.0 License
+6.0 Enforcing PRECIS Profiles
+7.0 Checking for Regressions
+8.0 Acknowledgements
+9.0 License
 
 ###
 
@@ -103,6 +105,11 @@ the createtables script.
 Thankfully, the Python language contains core libraries that enable
 us to complete those tasks. Therefore we import the relevant libraries.
 
+We also accept a few command-line options; each one is explained in the
+section that makes use of it. When PrecisMaker is imported as a library
+instead of being run as a script, the options simply take their default
+values.
+
 '''
 
 #
@@ -110,12 +117,133 @@ us to complete those tasks. Therefore we import the relevant libraries.
 #
 # Code to import the code libraries we need
 import os
+import re
 import sys
+import csv
+import json
+import time
+import array
+import bisect
+import threading
+import collections
+import hashlib
+import itertools
+import argparse
+import multiprocessing
+import unicodedata
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where we simply don't report peak memory
+    resource = None
 #
 # also set a flag for debugging
 #
 debug = False;
 #
+# command-line options (defaults only if we're imported as a library)
+#
+parser = argparse.ArgumentParser(description='Derive PRECIS properties from the Unicode Character Database.')
+parser.add_argument('--no-verify', dest='verify', action='store_false',
+                    help="skip the cross-check against Python's unicodedata module")
+parser.add_argument('--range', action='append', default=[], metavar='FIRST..LAST',
+                    help='classify only this range of codepoints, given in hex (may be repeated)')
+parser.add_argument('--plane', action='append', default=[], type=int,
+                    help='classify only this plane (may be repeated)')
+parser.add_argument('--explain', metavar='TEXT',
+                    help='explain the derived property of each character in TEXT')
+parser.add_argument('--query', metavar='EXPRESSION',
+                    help='list the codepoint ranges matching a set expression over categories and properties')
+parser.add_argument('--enforce', nargs=2, metavar=('PROFILE', 'TEXT'),
+                    help='enforce a PRECIS profile on TEXT and print the result')
+parser.add_argument('--generate-module', metavar='FILE',
+                    help='write a standalone Python module containing the derived property table')
+parser.add_argument('--publish', metavar='FILE',
+                    help='publish the tables in FILE, for worker processes to map into memory')
+parser.add_argument('--write-ranges', metavar='FILE',
+                    help='write the derived properties as collapsed codepoint ranges')
+parser.add_argument('--write-idna-ranges', metavar='FILE',
+                    help='write the IDNA2008 derived properties as collapsed codepoint ranges')
+parser.add_argument('--report', metavar='FILE',
+                    help='write counts of each derived property per block and per script (CSV, or JSON if FILE ends in .json)')
+parser.add_argument('--selftest', action='store_true',
+                    help='check our normalization against NormalizationTest.txt, if it is present')
+parser.add_argument('--golden', metavar='FILE',
+                    help='compare the derived properties against a golden table (ranges or createtables XML)')
+parser.add_argument('--history', metavar='FILE', default='PrecisMaker-history.json',
+                    help='JSON file of earlier timings used by --golden (default: %(default)s)')
+parser.add_argument('--threshold', type=float, default=0.25,
+                    help='fraction by which a run may be slower or bigger than usual (default: %(default)s)')
+parser.add_argument('--jobs', type=int, default=1,
+                    help='number of worker processes (default: %(default)s, i.e. do the work in-process)')
+if __name__ == '__main__':
+    options = parser.parse_args()
+else:
+    options = parser.parse_args([])
+    # a worker pool started while we're still being imported would wait
+    # forever on the import lock, so a library import does its work in-process
+    options.jobs = 1
+#
+# apply a function to a list of items, spread over a pool of worker
+# processes if we've been asked to use more than one
+#
+def poolMap(func, items):
+    if options.jobs <= 1:
+        return map(func, items)
+    pool = multiprocessing.Pool(options.jobs)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+#
+# the codepoint ranges we've been asked to classify, sorted and merged
+# (None means all of them)
+#
+def parseRange(spec):
+    cps = spec.split('..')
+    try:
+        first, last = int(cps[0], 16), int(cps[-1], 16)
+    except ValueError:
+        parser.error('not a codepoint range: ' + spec)
+    if len(cps) > 2 or not 0 <= first <= last <= 0x10FFFF:
+        parser.error('not a codepoint range: ' + spec)
+    return (first, last)
+
+for plane in options.plane:
+    if not 0 <= plane <= 16:
+        parser.error('no such plane: %d' % plane)
+if options.selftest and (options.range or options.plane):
+    parser.error('--selftest needs the whole codespace, not --range or --plane')
+
+cpranges = []
+for first, last in sorted([parseRange(spec) for spec in options.range] +
+                          [(plane << 16, (plane << 16) | 0xFFFF) for plane in options.plane]):
+    if cpranges and first <= cpranges[-1][1] + 1:
+        cpranges[-1] = (cpranges[-1][0], max(last, cpranges[-1][1]))
+    else:
+        cpranges.append((first, last))
+cpranges = cpranges or None
+#
+# the bitsets of section 4.2 and the case, bidi and quick check tables of
+# section 6 cover the whole codespace, so if all we're doing is
+# classifying some ranges we don't build them; explaining, enforcing,
+# querying and publishing can touch any codepoint, so they need the whole
+# codespace classified whatever ranges we were asked for
+#
+fulltables = cpranges is None or bool(options.explain or options.enforce or options.query or options.publish)
+#
+# keep track of how long each phase of the work takes
+#
+timings = collections.OrderedDict()
+phasestart = time.time()
+
+def endPhase(name):
+    global phasestart
+    now = time.time()
+    timings[name] = now - phasestart
+    phasestart = now
+#
 ### END CODE ###
 #
 
@@ -145,6 +273,14 @@ o UnicodeData.txt
 o DerivedCoreProperties.txt
 o HangulSyllableType.txt
 
+(When we get to enforcing the PRECIS profiles in section 6, we'll also
+need Scripts.txt and ArabicShaping.txt for the contextual rules, and
+CaseFolding.txt and DerivedNormalizationProps.txt for case mapping and
+normalization. The IDNA2008 table also needs PropList.txt and
+Blocks.txt. Those files are optional: if one of them is missing we say
+so and skip whatever needs it, and an option that asks for such a
+feature outright is an error.)
+
 Let's see exactly why we need those files, and what data we'll pull
 from them...
 
@@ -165,6 +301,10 @@ flagged for us in the UnicodeData.txt file.
 
 (E) LDH - Used in IDNA2008 but not in PRECIS.
 
+(Even though PRECIS doesn't use categories B through E, PrecisMaker
+prepares them anyway, so that a single run can produce the IDNA2008
+table alongside the PRECIS one; see section 3.16.)
+
 (F) Exceptions - This category, which lists 41 codepoints that handled
 in special ways, was defined for IDNA2008 and is re-used in PRECIS.
 Since this is merely a list of codepoints, we don't even need any of the
@@ -283,27 +423,127 @@ this example, all of the codepoints between U+3400 and U+4DB5 fall into
 "CJK Ideograph Extension A" and have a General Category of "Lo"
 ("Letter, other").
 
+The other files we read (DerivedCoreProperties.txt,
+HangulSyllableType.txt, and so on) share a simpler format: a codepoint
+or a range of codepoints, one or more fields separated by semicolons,
+and an optional comment.
+
+0000..001F    ; Cc # ...
+
+None of these files depends on any of the others, so we keep a list of
+every file we need along with the function that parses it. Each parser
+just returns a list of (first codepoint, last codepoint, fields)
+records, which we then join together into the structures described
+below, and if a future rule needs another file, all it takes is one
+more entry in the list.
+
+You might think that handing the list to a pool of worker processes
+would make loading faster, and the --jobs option lets you try. But the
+records have to be pickled in each worker and unpickled again in the
+main process, one after another, and for UnicodeData.txt that takes
+about four times as long as parsing the file in the first place. So
+unless you ask for more jobs, we parse the files in-process.
+
 '''
 
 #
 ### BEGIN CODE ###
 #
-# code to pull in the UnicodeData.txt file
-# each line in the file becomes an entry in the dictionary
+# code to parse the UnicodeData.txt file
+# each line becomes a record, and each First/Last pair becomes one record
+# covering the whole range
+#
+def parseUnicodeData(filename):
+    records = []
+    with open(filename) as f:
+        range_start = -1;
+        for line in f:
+            data = line.split(';');
+            cp = int(data[0], 16);
+            if data[1].endswith(", First>"):
+                range_start = cp;
+                continue;
+            if range_start >= 0:
+                records.append((range_start, cp, data));
+                range_start = -1;
+                continue;
+            records.append((cp, cp, data));
+    return records
+#
+# code to parse any file in the simpler "codepoints ; fields # comment"
+# format
+#
+def parsePropertyFile(filename):
+    records = []
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            data = [field.strip() for field in line.split(';')]
+            cps = data[0].split('..')
+            records.append((int(cps[0], 16), int(cps[-1], 16), data[1:]))
+    return records
+#
+# the files we need, and the function that parses each one
+#
+ucdfiles = {
+    'UnicodeData.txt': parseUnicodeData,
+    'DerivedCoreProperties.txt': parsePropertyFile,
+    'HangulSyllableType.txt': parsePropertyFile,
+    'Scripts.txt': parsePropertyFile,
+    'ArabicShaping.txt': parsePropertyFile,
+    'CaseFolding.txt': parsePropertyFile,
+    'PropList.txt': parsePropertyFile,
+    'Blocks.txt': parsePropertyFile,
+    'DerivedNormalizationProps.txt': parsePropertyFile,
+}
+#
+# only the first three files are required; the others are needed only by
+# some features, which we skip (or refuse to run, if they were asked for
+# explicitly) when one of their files is missing
+#
+features = {
+    'the IDNA2008 table': ('CaseFolding.txt', 'PropList.txt', 'Blocks.txt', 'DerivedNormalizationProps.txt'),
+    'the PRECIS profiles': ('Scripts.txt', 'ArabicShaping.txt', 'CaseFolding.txt', 'DerivedNormalizationProps.txt'),
+    'the report': ('Scripts.txt', 'Blocks.txt'),
+    'the normalization self-test': ('DerivedNormalizationProps.txt',),
+}
+missingfiles = set(name for names in features.values() for name in names if not os.path.exists(name))
+
+def missingFiles(feature):
+    return [name for name in features[feature] if name in missingfiles]
+
+for option, feature in (('write_idna_ranges', 'the IDNA2008 table'),
+                        ('enforce', 'the PRECIS profiles'),
+                        ('publish', 'the PRECIS profiles'),
+                        ('report', 'the report'),
+                        ('selftest', 'the normalization self-test')):
+    if getattr(options, option) and missingFiles(feature):
+        parser.error('--{} needs {}, which we could not find'.format(option.replace('_', '-'), ', '.join(missingFiles(feature))))
+for feature in ('the IDNA2008 table', 'the PRECIS profiles'):
+    if missingFiles(feature):
+        sys.stderr.write('{} not found, skipping {}\n'.format(', '.join(missingFiles(feature)), feature))
+#
+# parse one of the files (this runs in a worker process)
+#
+def parseFile(filename):
+    return ucdfiles[filename](filename)
+#
+# parse all of the files at once, and keep the records for each one (a
+# missing optional file simply has none)
+#
+ucdnames = sorted(set(ucdfiles) - missingfiles)
+ucd = dict(zip(ucdnames, poolMap(parseFile, ucdnames)))
+for name in missingfiles:
+    ucd[name] = []
+#
+# now pull in the UnicodeData.txt records
+# each codepoint becomes an entry in the dictionary
 #
 udict = {};
-with open('UnicodeData.txt') as f:
-    range_start = -1;
-    for line in f:
-        data = line.split(';');
-        cp = int(data[0], 16);
-        if range_start >= 0:
-            for i in xrange(range_start, cp):
-                udict[i] = data;
-            range_start = -1;
-        if data[1].endswith(", First>"):
-            range_start = cp;
-            continue;
+for start, end, data in ucd['UnicodeData.txt']:
+    for cp in xrange(start, end + 1):
         udict[cp] = data;
 #
 ### END CODE ###
@@ -558,27 +798,14 @@ line on the semicolon character.
 #
 ### BEGIN CODE ###
 #
-# code to pull in the DerivedCoreProperties.txt file
+# code to pull in the DerivedCoreProperties.txt records
 # we care only about lines that define Default_Ignorable_Code_Point
-# therefore we create a list of such codepoints
+# therefore we create a set of such codepoints
 #
-dicp = []
-with open('DerivedCoreProperties.txt') as f:
-    for line in f:
-        if line == '\n' or line.startswith('#'):
-            continue
-        data = line.split(';');
-        prop = data[1].split('#')[0].strip();
-        if prop != 'Default_Ignorable_Code_Point':
-            continue;
-        cps = data[0].strip().split('..');
-        if len(cps) == 1:
-            dicp.append(int(cps[0], 16));
-        else:
-            start = int(cps[0], 16);
-            end =  int(cps[1], 16) + 1;
-            for i in xrange(start, end):
-                dicp.append(i);
+dicp = set()
+for start, end, data in ucd['DerivedCoreProperties.txt']:
+    if data[0] == 'Default_Ignorable_Code_Point':
+        dicp.update(xrange(start, end + 1))
 #
 # define a function to determine if a codepoint is in
 # PrecisIgnorableProperties
@@ -632,29 +859,16 @@ HangulSyllableType.txt file from the Unicode Character Database.
 #
 ### BEGIN CODE ###
 #
-# code to pull in the HangulSyllableType.txt file
+# code to pull in the HangulSyllableType.txt records
 # we care only about lines that define Hangul Syllable Types of
 # Leading_Jamo, Vowel_Jamo, and Trailing_Jamo
 #
-# therefore we create a list of such codepoints
+# therefore we create a set of such codepoints
 #
-ohj = [];
-with open('HangulSyllableType.txt') as f:
-    for line in f:
-        if line == '\n' or line.startswith('#'):
-            continue
-        data = line.split(';');
-        prop = data[1].split('#')[0].strip();
-        if not prop in ('L', 'V', 'T'):
-	       continue
-        cps = data[0].strip().split('..');
-        if len(cps) == 1:
-            ohj.append(int(cps[0], 16));
-        else:
-            start = int(cps[0], 16);
-            end =  int(cps[1], 16) + 1;
-            for i in xrange(start, end):
-                ohj.append(i);
+ohj = set()
+for start, end, data in ucd['HangulSyllableType.txt']:
+    if data[0] in ('L', 'V', 'T'):
+        ohj.update(xrange(start, end + 1))
 #
 # define a function to determine if a codepoint is OldHangulJamo
 #
@@ -847,6 +1061,399 @@ def isHasCompat(cp):
 
 '''
 
+3.15 Normalization
+
+Two things we build from the data need Unicode normalization: the
+Unstable category of IDNA2008 (next section), and the PRECIS profiles,
+which normalize every string to NFC or NFKC (section 6). Python's
+unicodedata module can normalize, but only according to the version of
+Unicode that Python was built with, and we want the version in the
+files we were given. Fortunately everything normalization needs is in
+those files:
+
+o The decomposition of each codepoint (field 5 of UnicodeData.txt),
+  which is canonical unless it starts with a tag such as <compat>.
+
+o The Canonical_Combining_Class (field 3 of UnicodeData.txt), which
+  tells us how to put a run of combining marks in a canonical order.
+
+o The Full_Composition_Exclusion property from
+  DerivedNormalizationProps.txt, which lists the codepoints that a
+  canonical decomposition never composes back into.
+
+The Hangul syllables are the exception: they decompose and compose by
+arithmetic (see chapter 3 of the Unicode standard). The normalize()
+function puts all of this together for NFC, NFD, NFKC and NFKD.
+
+One more wrinkle: a 'narrow' build of Python 2 (the usual kind on
+Windows and macOS) holds each character outside the BMP as a pair of
+surrogates, so looping over a string doesn't give us its codepoints.
+The codepoints() function puts the pairs back together, and everything
+that looks characters up in our tables (here and in section 6) goes
+through it.
+
+'''
+
+#
+### BEGIN CODE ###
+#
+# turn a codepoint into a string (even on 'narrow' builds of Python)
+#
+def cpChar(cp):
+    return ('\\U%08x' % cp).decode('unicode-escape')
+#
+# ... and a string into a list of codepoints (a narrow build holds each
+# character outside the BMP as a pair of surrogates, which we put back
+# together)
+#
+def codepoints(s):
+    if sys.maxunicode > 0xFFFF:
+        return map(ord, s)
+    cps = []
+    i = 0
+    while i < len(s):
+        cp = ord(s[i])
+        if 0xD800 <= cp <= 0xDBFF and i + 1 < len(s) and 0xDC00 <= ord(s[i + 1]) <= 0xDFFF:
+            cp = 0x10000 + ((cp - 0xD800) << 10) + ord(s[i + 1]) - 0xDC00
+            i += 1
+        cps.append(cp)
+        i += 1
+    return cps
+#
+# the Canonical_Combining_Class of each codepoint
+#
+cccbuf = bytearray(0x110000)
+for start, end, data in ucd['UnicodeData.txt']:
+    if data[3] != '0':
+        cccbuf[start:end + 1] = bytearray([int(data[3])]) * (end - start + 1)
+#
+# the Full_Composition_Exclusion codepoints
+#
+exclusions = set()
+for start, end, data in ucd['DerivedNormalizationProps.txt']:
+    if data[0] == 'Full_Composition_Exclusion':
+        exclusions.update(xrange(start, end + 1))
+#
+# the canonical and compatibility decompositions from UnicodeData.txt, and
+# the pairs of codepoints that compose canonically (leaving out the
+# Full_Composition_Exclusion codepoints)
+#
+canonicalmap = {}
+compatmap = {}
+for start, end, data in ucd['UnicodeData.txt']:
+    if data[5]:
+        fields = data[5].split()
+        if fields[0].startswith('<'):
+            compatmap[start] = [int(cp, 16) for cp in fields[1:]]
+        else:
+            canonicalmap[start] = [int(cp, 16) for cp in fields]
+compositions = dict((tuple(pair), cp) for cp, pair in canonicalmap.iteritems()
+                    if len(pair) == 2 and cp not in exclusions)
+#
+# the Hangul syllables decompose and compose algorithmically (see chapter
+# 3 of the Unicode standard)
+#
+sbase, lbase, vbase, tbase = 0xAC00, 0x1100, 0x1161, 0x11A7
+lcount, vcount, tcount = 19, 21, 28
+scount = lcount * vcount * tcount
+#
+# fully decompose a codepoint, canonically or for compatibility
+#
+def decompose(cp, compatibility):
+    if sbase <= cp < sbase + scount:
+        index = cp - sbase
+        jamo = [lbase + index // (vcount * tcount), vbase + (index // tcount) % vcount]
+        if index % tcount:
+            jamo.append(tbase + index % tcount)
+        return jamo
+    mapping = canonicalmap.get(cp) or (compatibility and compatmap.get(cp))
+    if not mapping:
+        return [cp]
+    return [part for mapped in mapping for part in decompose(mapped, compatibility)]
+#
+# the canonical composition of two codepoints, or None
+#
+def compose(first, second):
+    if lbase <= first < lbase + lcount and vbase <= second < vbase + vcount:
+        return sbase + ((first - lbase) * vcount + second - vbase) * tcount
+    if (sbase <= first < sbase + scount and (first - sbase) % tcount == 0 and
+            tbase < second < tbase + tcount):
+        return first + second - tbase
+    return compositions.get((first, second))
+#
+# normalize a string to NFC, NFD, NFKC or NFKD
+#
+def normalize(form, s):
+    cps = []
+    for cp in codepoints(s):
+        cps.extend(decompose(cp, form in ('NFKC', 'NFKD')))
+    # put each run of combining marks in canonical order
+    i = 0
+    while i < len(cps):
+        j = i
+        while j < len(cps) and cccbuf[cps[j]]:
+            j += 1
+        if j - i > 1:
+            cps[i:j] = sorted(cps[i:j], key=lambda cp: cccbuf[cp])
+        i = j + 1
+    if form in ('NFC', 'NFKC'):
+        composed = []
+        starter = None
+        last = 0
+        for cp in cps:
+            ccc = cccbuf[cp]
+            if starter is not None and (last < ccc or (last == 0 and starter == len(composed) - 1)):
+                composite = compose(composed[starter], cp)
+                if composite is not None:
+                    composed[starter] = composite
+                    continue
+            if ccc == 0:
+                starter = len(composed)
+            last = ccc
+            composed.append(cp)
+        cps = composed
+    return u''.join(cpChar(cp) for cp in cps)
+#
+### END CODE ###
+#
+
+'''
+
+3.16 IDNA2008 Categories
+
+As we saw in section 2, PRECIS borrows the Exceptions, JoinControl,
+OldHangulJamo and Unassigned categories (and LetterDigits) from IDNA2008.
+That means the IDNA2008 table is mostly made of the same pieces as the
+PRECIS table, and there's no reason to run createtables separately, with
+a second parse of the same files and a second pass over the codespace,
+just to get it. So here we also prepare the four categories that only
+IDNA2008 uses (see RFC 5892, section 2), and in section 4 we classify
+each codepoint under both sets of rules at once.
+
+o LDH: the lowercase ASCII letters, the digits and the hyphen-minus.
+
+o Unstable: codepoints that don't survive NFKC(casefold(NFKC(cp))).
+  We take the case folding from CaseFolding.txt (the lines with status C
+  or F) and NFKC from the previous section. A codepoint that
+  has neither a decomposition nor a case folding can't possibly change,
+  so we only need to try the ones that have one or the other.
+
+o IgnorableProperties: codepoints that are Default_Ignorable_Code_Point
+  (which we already have from section 3.6), White_Space or
+  Noncharacter_Code_Point (both from PropList.txt).
+
+o IgnorableBlocks: the codepoints in the Combining Diacritical Marks for
+  Symbols, Musical Symbols and Ancient Greek Musical Notation blocks
+  (from Blocks.txt).
+
+One more difference: in IDNA2008 a noncharacter is not Unassigned,
+even though it has no entry in UnicodeData.txt, so it ends up being
+DISALLOWED because of IgnorableProperties.
+
+'''
+
+#
+### BEGIN CODE ###
+#
+# define a function to determine if a codepoint is in LDH
+#
+def isLDH(cp):
+    return cp == 0x002D or 0x0030 <= cp <= 0x0039 or 0x0061 <= cp <= 0x007A
+#
+# the full case folding of each codepoint that has one (section 6 uses
+# this too)
+#
+foldmap = {}
+for start, end, data in ucd['CaseFolding.txt']:
+    if data[0] in ('C', 'F'):
+        foldmap[start] = u''.join(cpChar(int(cp, 16)) for cp in data[1].split())
+#
+# create a set of the Unstable codepoints, trying only the ones with a
+# decomposition or a case folding
+#
+def nfkcCaseFold(s):
+    s = normalize('NFKC', s)
+    s = u''.join(foldmap.get(cp) or cpChar(cp) for cp in codepoints(s))
+    return normalize('NFKC', s)
+
+unstable = set()
+for start, end, data in ucd['UnicodeData.txt']:
+    if data[5] or start in foldmap:
+        if nfkcCaseFold(cpChar(start)) != cpChar(start):
+            unstable.add(start)
+
+def isUnstable(cp):
+    return cp in unstable
+#
+# pull in the White_Space and Noncharacter_Code_Point lines from
+# PropList.txt, and determine if a codepoint is in IgnorableProperties
+#
+whitespace = set()
+noncharacters = set()
+for start, end, data in ucd['PropList.txt']:
+    if data[0] == 'White_Space':
+        whitespace.update(xrange(start, end + 1))
+    elif data[0] == 'Noncharacter_Code_Point':
+        noncharacters.update(xrange(start, end + 1))
+
+def isIgnorableProperties(cp):
+    return cp in dicp or cp in whitespace or cp in noncharacters
+#
+# define a function to determine if a codepoint is in IgnorableBlocks
+#
+ignorableblocks = ('Combining Diacritical Marks for Symbols',
+                   'Musical Symbols', 'Ancient Greek Musical Notation')
+ignorableranges = [(start, end) for start, end, data in ucd['Blocks.txt'] if data[0] in ignorableblocks]
+
+def isIgnorableBlocks(cp):
+    return any(start <= cp <= end for start, end in ignorableranges)
+#
+# in IDNA2008, a noncharacter is not Unassigned
+#
+def isIDNAUnassigned(cp):
+    return isUnassigned(cp) and cp not in noncharacters
+#
+### END CODE ###
+#
+
+'''
+
+3.17 Cross-Checking Our Data
+
+Python ships with its own copy of the Unicode Character Database in the
+unicodedata module. That copy is tied to whatever version of Unicode the
+interpreter was built with, which is exactly why PrecisMaker reads the
+raw files instead. However, when the files we've been given happen to be
+the same version as the one inside the interpreter, we get a free sanity
+check: the General_Category and the compatibility decomposition of every
+assigned codepoint ought to be identical in both places.
+
+The UnicodeData.txt file doesn't say which version of Unicode it belongs
+to, but the first line of DerivedCoreProperties.txt does:
+
+# DerivedCoreProperties-6.2.0.txt
+
+The comparison is quick (a small fraction of a second), so by default
+we simply do it in-process. With the --jobs option we cut the sorted
+list of assigned codepoints into chunks and hand them to a pool of
+worker processes instead. The workers are forked after we've read the
+data, so they already have it: all we send each one is the first and
+last position of its chunk in the list, and all it sends back is the
+mismatches it found. The check runs automatically whenever the versions
+match; use --no-verify to skip it.
+
+Our normalization (section 3.15) gets a check of its own, which doesn't
+depend on the interpreter at all. Each version of the UCD comes with
+NormalizationTest.txt, whose lines give five strings c1 to c5: a source
+string and its NFC, NFD, NFKC and NFKD forms. UAX #15 lists the
+equalities between them that a conforming implementation must satisfy.
+With the --selftest option we check every line of the file, if it's
+there, and list the ones that fail. Since everything after this point
+depends on normalization, we stop with a non-zero status if any do.
+
+'''
+
+#
+### BEGIN CODE ###
+#
+# determine the version of the Unicode Character Database we've been given
+#
+def ucdVersion(filename='DerivedCoreProperties.txt'):
+    with open(filename) as f:
+        match = re.search(r'-(\d+\.\d+\.\d+)\.txt', f.readline())
+    if match:
+        return match.group(1)
+    return None
+
+ucdversion = ucdVersion()
+endPhase('load')
+#
+# the assigned codepoints, in order (set before any worker is forked)
+#
+verifycps = []
+#
+# compare the General_Category and decomposition of the codepoints between
+# two positions in verifycps against the unicodedata module, returning
+# only the mismatches
+#
+def verifyChunk(span):
+    mismatches = []
+    first, last = span
+    for cp in verifycps[first:last]:
+        # narrow builds of Python can't represent the supplementary planes
+        if cp > sys.maxunicode:
+            continue
+        gc = udict[cp][2]
+        decomp = udict[cp][5]
+        ch = unichr(cp)
+        hostgc = unicodedata.category(ch)
+        if hostgc != gc:
+            mismatches.append((cp, 'General_Category', gc, hostgc))
+        hostdecomp = unicodedata.decomposition(ch)
+        if hostdecomp != decomp and (decomp.startswith('<') or hostdecomp.startswith('<')):
+            mismatches.append((cp, 'Decomposition', decomp, hostdecomp))
+    return mismatches
+#
+# run the comparison in chunks (across a pool of worker processes if we've
+# been asked for one)
+#
+def verifyAgainstHost(chunksize=4096):
+    global verifycps
+    verifycps = sorted(udict)
+    spans = [(i, i + chunksize) for i in xrange(0, len(verifycps), chunksize)]
+    mismatches = []
+    for result in poolMap(verifyChunk, spans):
+        mismatches.extend(result)
+    return mismatches
+
+if options.verify and ucdversion == unicodedata.unidata_version:
+    for cp, what, ours, theirs in verifyAgainstHost():
+        sys.stderr.write("U+{:04X} {}: UnicodeData.txt has '{}', unicodedata has '{}'\n".format(cp, what, ours, theirs))
+#
+# the conformance test from UAX #15: for each form, the columns that the
+# form of columns 1 to 5 must equal
+#
+normalizationtests = {
+    'NFC': (2, 2, 2, 4, 4),
+    'NFD': (3, 3, 3, 5, 5),
+    'NFKC': (4, 4, 4, 4, 4),
+    'NFKD': (5, 5, 5, 5, 5),
+}
+
+def normalizationSelfTest(filename='NormalizationTest.txt'):
+    failures = []
+    count = 0
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line or line.startswith('@'):
+                continue
+            count += 1
+            columns = [u''.join(cpChar(int(cp, 16)) for cp in field.split())
+                       for field in line.split(';')[:5]]
+            for form, expected in sorted(normalizationtests.items()):
+                for column, want in enumerate(expected):
+                    if normalize(form, columns[column]) != columns[want - 1]:
+                        failures.append((line, form, column + 1, want))
+    return count, failures
+
+if options.selftest:
+    if not os.path.exists('NormalizationTest.txt'):
+        sys.stderr.write('NormalizationTest.txt not found, skipping the normalization self-test\n')
+    else:
+        count, failures = normalizationSelfTest()
+        for line, form, column, want in failures:
+            sys.stderr.write('{}: {}(c{}) != c{}\n'.format(line, form, column, want))
+        sys.stderr.write('NormalizationTest.txt: {} lines, {} failures\n'.format(count, len(failures)))
+        if failures:
+            sys.exit(1)
+endPhase('verify')
+#
+### END CODE ###
+#
+
+'''
+
 ###
 
 4. Running the Algorithm
@@ -870,6 +1477,56 @@ pseudocode from the PRECIS framework specification.
    Else If .cp. .in. Punctuation Then SAFE_DIS or FREE_PVAL;
    Else DISALLOWED;
 
+Usually we run the algorithm over the whole codespace. However, if all
+you want is to look at a single block, or to regenerate the table for
+just the Basic Multilingual Plane (say, for an embedded device), you can
+pass one or more --range options (such as --range 0370..03FF) or --plane
+options. In that case we classify only the codepoints in those ranges
+and print the results in the range-collapsed format described in
+section 5.2. We still read all of the UCD records, since a codepoint in
+the range can depend on one outside it (a decomposition, say, or a case
+folding), and unless you also ask for --explain, --enforce, --query or
+--publish, we skip the tables of sections 4.2 and 6, which cover the
+whole codespace whatever ranges you ask for. Those options can touch any
+codepoint, so with them we classify everything and only the output is
+limited to the ranges.
+From Python, the classifyRanges() function does the same for a list of
+(first, last) pairs, using the data that has already been loaded.
+
+Either way, most of the codespace is unassigned (about 70% of it, at the
+time of writing), and there's no point asking a long series of questions
+about each of those codepoints just to learn that it is UNASSIGNED.
+Instead we walk only the assigned ranges that we found in
+UnicodeData.txt (including the First/Last pairs), along with the
+Exceptions, which come before Unassigned in the rules. The compact
+buffers start out saying UNASSIGNED for every codepoint, so the gaps
+between the assigned ranges are filled in without visiting them at all,
+and the time the algorithm takes depends on the number of assigned
+characters rather than on the size of the codespace. (The status
+dictionary likewise stores entries only for the codepoints we visit,
+but looking up any other codepoint in it still gives UNASSIGNED, just
+as it did when every codepoint had an entry.)
+
+While we're visiting each codepoint anyway, we also run the IDNA2008
+algorithm from RFC 5892 on it, using the categories from section 3:
+
+   If .cp. .in. Exceptions Then Exceptions(cp);
+   Else If .cp. .in. BackwardCompatible Then BackwardCompatible(cp);
+   Else If .cp. .in. Unassigned Then UNASSIGNED;
+   Else If .cp. .in. LDH Then PVALID;
+   Else If .cp. .in. JoinControl Then CONTEXTJ;
+   Else If .cp. .in. Unstable Then DISALLOWED;
+   Else If .cp. .in. IgnorableProperties Then DISALLOWED;
+   Else If .cp. .in. IgnorableBlocks Then DISALLOWED;
+   Else If .cp. .in. OldHangulJamo Then DISALLOWED;
+   Else If .cp. .in. LetterDigits Then PVALID;
+   Else DISALLOWED;
+
+The results go into a second pair of compact buffers, and the
+--write-idna-ranges option writes them out (see section 5.2). The only
+extra codepoints we need to visit are the noncharacters, which are
+DISALLOWED in IDNA2008 rather than UNASSIGNED.
+
 '''
 
 #
@@ -878,72 +1535,385 @@ pseudocode from the PRECIS framework specification.
 # code to determine the status of each codepoint
 #
 # first create a dictionary specifying the status of each codepoint
+# (only the codepoints we visit get an entry; looking up any other
+# codepoint gives UNASSIGNED, without adding an entry for it)
+#
+class StatusDict(dict):
+    def __missing__(self, cp):
+        return 'UNASSIGNED'
+
+status = StatusDict();
+#
+# we also keep the same information in a compact form: one byte per
+# codepoint, holding the position of the derived property in a tuple
+# (UNASSIGNED comes first so that a fresh buffer starts out unassigned)
+#
+properties = ('UNASSIGNED', 'PVALID', 'CONTEXTJ', 'CONTEXTO', 'DISALLOWED', 'FREE_PVAL')
+propindex = dict((prop, i) for i, prop in enumerate(properties))
+pbuf = bytearray(0x110000)
+#
+# and likewise for the rule that decided each derived property
+#
+reasons = ('Unassigned', 'Exceptions', 'BackwardCompatible', 'ASCII7',
+           'JoinControl', 'OldHangulJamo', 'PrecisIgnorableProperties',
+           'Controls', 'HasCompat', 'LetterDigits', 'OtherLetterDigits',
+           'Spaces', 'Symbols', 'Punctuation', 'default')
+reasonindex = dict((reason, i) for i, reason in enumerate(reasons))
+rbuf = bytearray(0x110000)
 #
-status = {};
+# and likewise for the IDNA2008 derived property (which uses the same
+# property names) and the rule that decided it
 #
-# We iterate over all possible codepoints (even the ones that have not yet
+idnareasons = ('Unassigned', 'Exceptions', 'BackwardCompatible', 'LDH',
+               'JoinControl', 'Unstable', 'IgnorableProperties',
+               'IgnorableBlocks', 'OldHangulJamo', 'LetterDigits', 'default')
+idnareasonindex = dict((reason, i) for i, reason in enumerate(idnareasons))
+idnabuf = bytearray(0x110000)
+idnarbuf = bytearray(0x110000)
+#
+# We consider all possible codepoints (even the ones that have not yet
 # been assigned)
 #
 firstcp = 0x0000;
 lastcp = 0x10FFFD;
 #
-# here we iterate through all the codepoints and, for each one, call a
-# series of functions that tell us whether the codepoint is in the
-# relevant PRECIS category
+# ... unless we've been asked to look at only some ranges of codepoints
+# (and nothing that needs the rest of them; see fulltables above)
+#
+classifyranges = [(firstcp, lastcp - 1)] if fulltables else cpranges
+#
+# however, most of those codepoints are unassigned, and the buffers above
+# already say so; therefore we visit only the assigned ranges (plus the
+# Exceptions, which come before Unassigned in the rules, and the
+# noncharacters, which IDNA2008 doesn't count as Unassigned) that fall
+# within the ranges we're considering, merged together in order
+#
+def visitRanges():
+    spans = [(start, end) for start, end, data in ucd['UnicodeData.txt']]
+    spans += [(cp, cp) for cp in exceptions]
+    spans += [(cp, cp) for cp in noncharacters]
+    pieces = []
+    for start, end in spans:
+        for first, last in classifyranges:
+            if start <= last and first <= end:
+                pieces.append((max(start, first), min(end, last)))
+    visit = []
+    for start, end in sorted(pieces):
+        if visit and start <= visit[-1][1] + 1:
+            visit[-1] = (visit[-1][0], max(end, visit[-1][1]))
+        else:
+            visit.append((start, end))
+    return visit
+#
+# define a function that calls a series of functions that tell us whether
+# the codepoint is in the relevant PRECIS category, and returns both the
+# derived property and the category (or 'rule') that decided it
 #
-for cp in xrange(firstcp, lastcp):
-    # convert each integer to a hex string
-    cpstr = "U+{:04X}".format(cp);
-    # now that we have the codepoint, check each PRECIS category
+def classify(cp):
     if isExceptions(cp):
-        status[cp] = exceptions[cp]
-        if debug: print cpstr + " is " + status[cp] + " (Exceptions)";
+        return (exceptions[cp], 'Exceptions')
     #elif isBackwardCompatible(cp):        # no-op for now
     elif isUnassigned(cp):
-        status[cp] = "UNASSIGNED"
-        if debug: print cpstr + " is " + status[cp];
+        return ("UNASSIGNED", 'Unassigned')
     elif isASCII7(cp):
-        status[cp] = "PVALID"
-        if debug: print cpstr + " is " + status[cp] + " (ASCII7)";
+        return ("PVALID", 'ASCII7')
     elif isJoinControl(cp):
-        status[cp] = "CONTEXTJ"
-        if debug: print cpstr + " is " + status[cp] + " (JoinControl)";
+        return ("CONTEXTJ", 'JoinControl')
     elif isOldHangulJamo(cp):
-        status[cp] = "DISALLOWED"
-        if debug: print cpstr + " is " + status[cp] + " (OldHangulJamo)";
+        return ("DISALLOWED", 'OldHangulJamo')
     elif isPrecisIgnorableProperties(cp):
-        status[cp] = "DISALLOWED"
-        if debug: print cpstr + " is " + status[cp] + " (PrecisIgnorableProperties)";
+        return ("DISALLOWED", 'PrecisIgnorableProperties')
     elif isControls(cp):
-        status[cp] = "DISALLOWED"
-        if debug: print cpstr + " is " + status[cp] + " (Controls)";
+        return ("DISALLOWED", 'Controls')
     elif isHasCompat(cp):
-        status[cp] = "FREE_PVAL"
-        # additional lines for debugging
-        item = udict[cp]
-        compat = item[5]
-        cdata = compat.split('>');
-        ctype = cdata[0]
-        cpoints = cdata[1]
-        if debug: print cpstr + " is " + status[cp] + " (compatibility equivalence of type " + ctype + "> to the codepoint(s)" + cpoints + ")";
+        return ("FREE_PVAL", 'HasCompat')
     elif isLetterDigits(cp):
-        status[cp] = "PVALID"
-        if debug: print cpstr + " is " + status[cp] + " (LetterDigits)";
+        return ("PVALID", 'LetterDigits')
     elif isOtherLetterDigits(cp):
-        status[cp] = "FREE_PVAL"
-        if debug: print cpstr + " is " + status[cp] + " (OtherLetterDigits)";
+        return ("FREE_PVAL", 'OtherLetterDigits')
     elif isSpaces(cp):
-        status[cp] = "FREE_PVAL"
-        if debug: print cpstr + " is " + status[cp] + " (Spaces)";
+        return ("FREE_PVAL", 'Spaces')
     elif isSymbols(cp):
-        status[cp] = "FREE_PVAL"
-        if debug: print cpstr + " is " + status[cp] + " (Symbols)";
+        return ("FREE_PVAL", 'Symbols')
     elif isPunctuation(cp):
-        status[cp] = "FREE_PVAL"
-        if debug: print cpstr + " is " + status[cp] + " (Punctuation)";
+        return ("FREE_PVAL", 'Punctuation')
     else:
-        status[cp] = "DISALLOWED"
-        if debug: print cpstr + " is " + status[cp] + " by default";
+        return ("DISALLOWED", 'default')
+#
+# the same for the IDNA2008 rules
+#
+def classifyIDNA(cp):
+    if isExceptions(cp):
+        return (exceptions[cp], 'Exceptions')
+    #elif isBackwardCompatible(cp):        # no-op for now
+    elif isIDNAUnassigned(cp):
+        return ("UNASSIGNED", 'Unassigned')
+    elif isLDH(cp):
+        return ("PVALID", 'LDH')
+    elif isJoinControl(cp):
+        return ("CONTEXTJ", 'JoinControl')
+    elif isUnstable(cp):
+        return ("DISALLOWED", 'Unstable')
+    elif isIgnorableProperties(cp):
+        return ("DISALLOWED", 'IgnorableProperties')
+    elif isIgnorableBlocks(cp):
+        return ("DISALLOWED", 'IgnorableBlocks')
+    elif isOldHangulJamo(cp):
+        return ("DISALLOWED", 'OldHangulJamo')
+    elif isLetterDigits(cp):
+        return ("PVALID", 'LetterDigits')
+    else:
+        return ("DISALLOWED", 'default')
+#
+# here we iterate through the codepoints we need to visit and, for each
+# one, record the result in both the dictionary and the compact buffers,
+# along with the IDNA2008 result (if we have the files for it)
+#
+idnatable = not missingFiles('the IDNA2008 table')
+for cp in itertools.chain(*[xrange(first, last + 1) for first, last in visitRanges()]):
+    prop, reason = classify(cp)
+    status[cp] = prop
+    pbuf[cp] = propindex[prop]
+    rbuf[cp] = reasonindex[reason]
+    if idnatable:
+        iprop, ireason = classifyIDNA(cp)
+        idnabuf[cp] = propindex[iprop]
+        idnarbuf[cp] = idnareasonindex[ireason]
+    if debug:
+        # convert each integer to a hex string
+        cpstr = "U+{:04X}".format(cp);
+        if reason == 'HasCompat':
+            # additional lines for debugging
+            ctype, cpoints = udict[cp][5].split('>')
+            print cpstr + " is " + prop + " (compatibility equivalence of type " + ctype + "> to the codepoint(s)" + cpoints + ")";
+        else:
+            print cpstr + " is " + prop + " (" + reason + ")";
+endPhase('classify')
+#
+# classify some ranges of codepoints on request, returning runs of
+# (first, last, property, rule) for codepoints that share both
+#
+def classifyRanges(ranges):
+    runs = []
+    for first, last in ranges:
+        for cp in xrange(first, last + 1):
+            prop, reason = classify(cp)
+            if runs and runs[-1][1] == cp - 1 and runs[-1][2] == prop and runs[-1][3] == reason:
+                runs[-1][1] = cp
+            else:
+                runs.append([cp, cp, prop, reason])
+    return [tuple(run) for run in runs]
+#
+### END CODE ###
+#
+
+'''
+
+4.1 Explaining the Results
+
+Sooner or later someone will want to know why their name was rejected.
+Setting the debug flag will tell you, but it does so by printing a line
+for every codepoint in Unicode, which is a bit much when you're curious
+about just one character. So as we go through the algorithm we also
+record the rule that decided each codepoint (Exceptions, OldHangulJamo,
+HasCompat, and so on) in a buffer that holds one byte per codepoint,
+right next to the buffer for the derived property itself. Answering the
+question is then a matter of looking up two bytes.
+
+The explain() function does this for a single codepoint, and the
+explainString() function does it for every character in a string. You
+can also pass a string to the --explain option.
+
+'''
+
+#
+### BEGIN CODE ###
+#
+# explain the derived property of a single codepoint
+#
+def explain(cp):
+    return "U+{:04X} is {} ({})".format(cp, properties[pbuf[cp]], reasons[rbuf[cp]])
+#
+# explain the derived property of each character in a string
+#
+def explainString(s):
+    return [explain(cp) for cp in codepoints(s)]
+
+if options.explain:
+    for line in explainString(options.explain.decode('utf-8')):
+        print line
+#
+### END CODE ###
+#
+
+'''
+
+4.2 Asking Questions About Categories
+
+Reviewers tend to ask questions like "which Symbols in plane 1 are
+FREE_PVAL?" or "which LetterDigits are also HasCompat?". Each of those
+could be answered by writing yet another loop over all the codepoints,
+but there's a neater way: represent each category, and each derived
+property, as a 'bitset' in which bit number N is set if codepoint N is
+in the set. Python's integers can be as big as we like, so a bitset for
+the entire codespace is just one (rather large) integer, and the
+questions become the ordinary operators for union (|), intersection (&)
+and difference (& ~), which Python evaluates in a fraction of a
+millisecond.
+
+To build the bitsets without visiting every codepoint in Python, we
+first record the General_Category of every codepoint in a buffer that
+holds one byte per codepoint (just like the derived properties). Turning
+such a buffer into a bitset is then a matter of translating each byte to
+the character '0' or '1' and reading the result as a binary number.
+
+The union(), intersection() and difference() functions accept either
+bitsets or the names of categories and derived properties, and
+bitRanges() lists the codepoint ranges in the result. The --query option
+does the same from the command line, reading the expression from left
+to right:
+
+--query "Symbols & FREE_PVAL & plane1"
+--query "LetterDigits & HasCompat - 0000..00FF"
+
+'''
+
+#
+### BEGIN CODE ###
+#
+# record the General_Category of each codepoint, with 'Cn' (unassigned) first
+#
+gcnames = ['Cn'] + sorted(set(data[2] for start, end, data in ucd['UnicodeData.txt']) - set(['Cn']))
+gcindex = dict((gc, i) for i, gc in enumerate(gcnames))
+gcbuf = bytearray(0x110000)
+if fulltables:
+    for start, end, data in ucd['UnicodeData.txt']:
+        gcbuf[start:end + 1] = bytearray([gcindex[data[2]]]) * (end - start + 1)
+#
+# turn a buffer into a bitset of the codepoints whose byte is one of codes
+#
+def bufferBits(buf, codes):
+    table = bytearray('0' * 256)
+    for code in codes:
+        table[code] = ord('1')
+    return int(str(buf.translate(table))[::-1], 2)
+#
+# turn a collection of codepoints into a bitset
+#
+def setBits(cps):
+    buf = bytearray(0x110000)
+    for cp in cps:
+        buf[cp] = 1
+    return bufferBits(buf, (1,))
+#
+# the bitset for a range of codepoints, and for a whole plane
+#
+def rangeBits(first, last):
+    return ((1 << (last - first + 1)) - 1) << first
+
+def planeBits(plane):
+    return rangeBits(plane << 16, (plane << 16) | 0xFFFF)
+#
+# the bitsets for each of the PRECIS categories
+#
+def gcBits(*gcs):
+    return bufferBits(gcbuf, [gcindex[gc] for gc in gcs if gc in gcindex])
+
+bitsets = {}
+if fulltables:
+    bitsets.update({
+        'Exceptions': setBits(exceptions),
+        'Unassigned': gcBits('Cn'),
+        'ASCII7': rangeBits(33, 126),
+        'JoinControl': setBits((0x200C, 0x200D)),
+        'OldHangulJamo': setBits(ohj),
+        'PrecisIgnorableProperties': setBits(dicp),
+        'Controls': gcBits('Cc'),
+        'HasCompat': setBits(cp for start, end, data in ucd['UnicodeData.txt']
+                             if data[5].startswith('<')
+                             for cp in xrange(start, end + 1)),
+        'LetterDigits': gcBits('Ll', 'Lu', 'Lm', 'Lo', 'Mn', 'Mc', 'Nd'),
+        'OtherLetterDigits': gcBits('Lt', 'Nl', 'No', 'Me'),
+        'Spaces': gcBits('Zs'),
+        'Symbols': gcBits('Sm', 'Sc', 'Sk', 'So'),
+        'Punctuation': gcBits('Pc', 'Pd', 'Ps', 'Pe', 'Pi', 'Pf', 'Po'),
+    })
+    #
+    # ... and for each of the derived properties
+    #
+    for prop in properties:
+        bitsets[prop] = bufferBits(pbuf, (propindex[prop],))
+endPhase('bitsets')
+#
+# accept either a bitset or the name of one
+#
+def toBits(bits):
+    if isinstance(bits, basestring):
+        return bitsets[bits]
+    return bits
+#
+# set algebra on bitsets
+#
+def union(*sets):
+    return reduce(lambda a, b: a | toBits(b), sets, 0)
+
+def intersection(first, *sets):
+    return reduce(lambda a, b: a & toBits(b), sets, toBits(first))
+
+def difference(first, *sets):
+    return reduce(lambda a, b: a & ~toBits(b), sets, toBits(first))
+#
+# list the (first, last) codepoint ranges in a bitset, and count them
+#
+def bitRanges(bits):
+    return [(m.start(), m.end() - 1) for m in re.finditer('1+', bin(toBits(bits))[:1:-1])]
+
+def bitCount(bits):
+    return bin(toBits(bits)).count('1')
+#
+# evaluate a query such as "Symbols & FREE_PVAL & plane1" from left to right
+# the operands are category or property names, planes, or codepoint ranges
+# (a name comes first, so that a name such as 'Cc' isn't taken for hex)
+#
+def queryOperand(word):
+    if word in bitsets:
+        return bitsets[word]
+    match = re.match(r'^plane(\d+)$', word)
+    if match and int(match.group(1)) <= 16:
+        return planeBits(int(match.group(1)))
+    match = re.match(r'^([0-9A-Fa-f]+)(?:\.\.([0-9A-Fa-f]+))?$', word)
+    if match:
+        first, last = int(match.group(1), 16), int(match.group(2) or match.group(1), 16)
+        if first <= last <= 0x10FFFF:
+            return rangeBits(first, last)
+    raise ValueError("unknown operand '" + word + "' in query")
+
+def query(expression):
+    words = expression.split()
+    if len(words) % 2 == 0:
+        raise ValueError("a query must be operands separated by operators, not '" + expression + "'")
+    bits = queryOperand(words[0])
+    for op, word in zip(words[1::2], words[2::2]):
+        if op == '&':
+            bits = intersection(bits, queryOperand(word))
+        elif op == '|':
+            bits = union(bits, queryOperand(word))
+        elif op == '-':
+            bits = difference(bits, queryOperand(word))
+        else:
+            raise ValueError("unknown operator '" + op + "' in query")
+    return bits
+
+if options.query:
+    try:
+        bits = query(options.query)
+    except ValueError, e:
+        parser.error(str(e))
+    for first, last in bitRanges(bits):
+        if first == last:
+            print "{:04X}".format(first)
+        else:
+            print "{:04X}..{:04X}".format(first, last)
 #
 ### END CODE ###
 #
@@ -981,9 +1951,1208 @@ the derived property for each codepoint. The format looks like this:
 
 '''
 
+5.1 Generating a Python Table Module
+
+Running PrecisMaker means shipping the UCD text files and spending a few
+seconds parsing and classifying them. That's fine for checking the
+specifications, but a server that just wants to know the derived
+property of a codepoint shouldn't have to do any of that. So with the
+--generate-module option PrecisMaker writes a standalone Python module
+that contains the results in compact form, along with a tiny lookup()
+function. The module records the Unicode version and the SHA-256 hashes
+of the files it was built from, so you can always tell where it came
+from. It also contains a SharedTables class for attaching to the tables
+that PrecisMaker publishes with the --publish option (see section 6.2).
+
+To keep the module small we use a 'two-stage table', which is the same
+trick that Python's own unicodedata module uses. We cut the codespace
+into blocks of 128 codepoints. Many blocks are identical (think of all
+those unassigned planes), so we store each distinct block only once in
+the second stage, and the first stage says which distinct block goes
+with each position in the codespace. Looking up a codepoint is then two
+array accesses and no parsing at all.
+
+'''
+
+#
+### BEGIN CODE ###
+#
+# build a two-stage table from a sequence with one value per codepoint
+# the result is (shift, stage1, stage2), where both stages are arrays
+#
+def compactTable(values, shift=7):
+    size = 1 << shift
+    seen = {}
+    stage1 = array.array('H')
+    if max(values) < 256:
+        stage2 = array.array('B')
+    else:
+        stage2 = array.array('H')
+    for start in xrange(0, len(values), size):
+        block = tuple(values[start:start + size])
+        if block not in seen:
+            seen[block] = len(seen)
+            stage2.extend(block)
+        stage1.append(seen[block])
+    return (shift, stage1, stage2)
+#
+# look up a codepoint in a two-stage table
+#
+def compactLookup(table, cp):
+    shift, stage1, stage2 = table
+    return stage2[(stage1[cp >> shift] << shift) | (cp & ((1 << shift) - 1))]
+#
+# compute the SHA-256 hash of one of our input files
+#
+def fileHash(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+#
+# the contents of an array as bytes, with multi-byte entries little-endian
+#
+def arrayBytes(arr):
+    if arr.itemsize > 1 and sys.byteorder == 'big':
+        arr = array.array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tostring()
+#
+# write an array as an assignment to a bytes literal, split over lines;
+# multi-byte entries are stored little-endian and swapped on import if need be
+#
+def writeArray(f, name, arr):
+    data = arrayBytes(arr)
+    f.write("{} = array('{}', (\n".format(name, arr.typecode))
+    for i in xrange(0, len(data), 64):
+        f.write('    b' + repr(data[i:i + 64]) + '\n')
+    f.write('))\n')
+    if arr.itemsize > 1:
+        f.write("if sys.byteorder == 'big':\n    {}.byteswap()\n".format(name))
+#
+# the class that lets the standalone module attach to published tables
+#
+sharedtablesource = """
+
+def _characters(s):
+    '''Yield the codepoint and text of each character in a string (on a narrow
+    build, a character outside the BMP is a pair of surrogates).'''
+    i = 0
+    while i < len(s):
+        cp = ord(s[i])
+        if (sys.maxunicode <= 0xFFFF and 0xD800 <= cp <= 0xDBFF and
+                i + 1 < len(s) and 0xDC00 <= ord(s[i + 1]) <= 0xDFFF):
+            yield 0x10000 + ((cp - 0xD800) << 10) + ord(s[i + 1]) - 0xDC00, s[i:i + 2]
+            i += 2
+        else:
+            yield cp, s[i]
+            i += 1
+
+class SharedTables(object):
+    '''The tables published by PrecisMaker --publish, mapped read-only.'''
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:8] != b'PRECIS\\x00\\x01':
+            raise ValueError('not a PrecisMaker table file: %r' % (filename,))
+        size = struct.unpack_from('<I', self._map, 8)[0]
+        header = json.loads(self._map[12:12 + size].decode('utf-8'))
+        self.unicode_version = header['unicode']
+        self.properties = tuple(header['properties'])
+        self.reasons = tuple(header['reasons'])
+        self._shift = header['shift']
+        self._sections = header['sections']
+
+    def _item(self, name, i):
+        offset, count, typecode = self._sections[name]
+        if not 0 <= i < count:
+            raise IndexError('%s index out of range' % (name,))
+        return struct.unpack_from('<' + typecode, self._map, offset + i * struct.calcsize(typecode))[0]
+
+    def _string(self, i):
+        start = self._item('strings.offsets', i)
+        end = self._item('strings.offsets', i + 1)
+        offset = self._sections['strings.data'][0]
+        return self._map[offset + start:offset + end].decode('utf-8')
+
+    def lookup(self, cp):
+        '''Return the PRECIS derived property of an integer codepoint.'''
+        return self.properties[self._item('properties', cp)]
+
+    def reason(self, cp):
+        '''Return the rule that decided the derived property of a codepoint.'''
+        return self.reasons[self._item('reasons', cp)]
+
+    def mapString(self, profile, s, comparison=False):
+        '''Apply the width, space and case mappings of a profile to a string.'''
+        name = profile + ('.comparison' if comparison else '.mapping')
+        if name + '.stage1' not in self._sections:
+            name = profile + '.mapping'
+        mask = (1 << self._shift) - 1
+        out = []
+        for cp, ch in _characters(s):
+            block = self._item(name + '.stage1', cp >> self._shift)
+            i = self._item(name + '.stage2', (block << self._shift) | (cp & mask))
+            out.append(self._string(i) if i else ch)
+        return u''.join(out)
+
+    def close(self):
+        self._map.close()
+"""
+#
+# write the standalone module
+#
+def generateModule(filename):
+    shift, stage1, stage2 = compactTable(pbuf)
+    with open(filename, 'w') as f:
+        f.write('# Generated by PrecisMaker. Do not edit.\n')
+        f.write("'''PRECIS derived properties for Unicode {}.'''\n\n".format(ucdversion))
+        f.write('import sys\nimport json\nimport mmap\nimport struct\nfrom array import array\n\n')
+        f.write('UNICODE_VERSION = {!r}\n'.format(ucdversion))
+        f.write('INPUT_HASHES = {\n')
+        for name in ucdnames:
+            f.write('    {!r}: {!r},\n'.format(name, fileHash(name)))
+        f.write('}\n')
+        f.write('PROPERTIES = {!r}\n\n'.format(properties))
+        f.write('_SHIFT = {}\n_MASK = {}\n'.format(shift, (1 << shift) - 1))
+        writeArray(f, '_STAGE1', stage1)
+        writeArray(f, '_STAGE2', stage2)
+        f.write('\n\ndef lookup(cp):\n')
+        f.write("    '''Return the PRECIS derived property of an integer codepoint.'''\n")
+        f.write('    if not 0 <= cp <= 0x10FFFF:\n')
+        f.write("        raise ValueError('not a codepoint: %r' % (cp,))\n")
+        f.write('    return PROPERTIES[_STAGE2[(_STAGE1[cp >> _SHIFT] << _SHIFT) | (cp & _MASK)]]\n')
+        f.write(sharedtablesource)
+
+if options.generate_module:
+    generateModule(options.generate_module)
+#
+### END CODE ###
+#
+
+'''
+
+5.2 Range-Collapsed Output
+
+Until the XML output is done, and for comparing the results of one run
+with another, it's handy to have a more compact text format. Neighboring
+codepoints tend to share both a derived property and the rule that
+decided it, so the --write-ranges option writes one line for each run of
+such codepoints, in the same format as the UCD files themselves (if we
+were asked to classify only some ranges of codepoints, we write only
+those, and without --write-ranges or --golden we print them instead).
+The --write-idna-ranges option does the same for the IDNA2008 table
+that we built in the same pass (see section 4):
+
+0000..001F    ; DISALLOWED # Controls
+0020          ; FREE_PVAL  # Spaces
+0021..007E    ; PVALID     # ASCII7
+
+'''
+
+#
+### BEGIN CODE ###
+#
+# the buffers and rule names behind each table
+#
+derivedtables = {
+    'PRECIS': (pbuf, rbuf, reasons),
+    'IDNA2008': (idnabuf, idnarbuf, idnareasons),
+}
+#
+# find the runs of codepoints that share a derived property and a rule
+#
+def propertyRuns(table='PRECIS'):
+    props, rules, rulenames = derivedtables[table]
+    for first, last in cpranges or [(0, 0x10FFFF)]:
+        cp = first
+        for (prop, reason), group in itertools.groupby(itertools.izip(props[first:last + 1], rules[first:last + 1])):
+            count = sum(1 for item in group)
+            yield (cp, cp + count - 1, properties[prop], rulenames[reason])
+            cp += count
+#
+# write the runs to a file
+#
+def writeRuns(f, table='PRECIS'):
+    for first, last, prop, reason in propertyRuns(table):
+        if first == last:
+            cps = '{:04X}'.format(first)
+        else:
+            cps = '{:04X}..{:04X}'.format(first, last)
+        f.write('{:<14}; {:<10} # {}\n'.format(cps, prop, reason))
+
+def writeRanges(filename, table='PRECIS'):
+    with open(filename, 'w') as f:
+        f.write('# {} derived properties for Unicode {}, generated by PrecisMaker\n\n'.format(table, ucdversion))
+        writeRuns(f, table)
+
+if options.write_idna_ranges:
+    writeRanges(options.write_idna_ranges, 'IDNA2008')
+if options.write_ranges:
+    writeRanges(options.write_ranges)
+elif cpranges and not options.golden and not options.report:
+    writeRuns(sys.stdout)
+#
+### END CODE ###
+#
+
+'''
+
+5.3 Statistics by Block and Script
+
+For every new version of Unicode, reviewers want to know how the derived
+properties are spread over the blocks and the scripts: how many of the
+new Cherokee characters are PVALID, how many Symbols are FREE_PVAL, and
+so on. The --report option writes a table with one row for each block
+(from Blocks.txt) and each script (from Scripts.txt), giving the number
+of codepoints with each derived property. The table is CSV, unless the
+filename ends in .json:
+
+kind,name,first,last,total,UNASSIGNED,PVALID,CONTEXTJ,...
+block,Basic Latin,0000,007F,128,0,94,0,...
+
+We don't need to look at the codepoints one at a time to do this. A
+block is a range of codepoints, and so is each line of Scripts.txt (once
+we join neighboring lines for the same script), and the derived
+properties are sitting in a buffer with one byte per codepoint. So for
+each range we take that slice of the buffer and count the bytes for
+each property, which Python does at the speed of C. Codepoints that
+aren't in any block are counted under No_Block, and codepoints that
+don't have a script are counted under Unknown, so that each half of the
+table adds up to the whole codespace (or to the ranges we were asked to
+classify).
+
+'''
+
+#
+### BEGIN CODE ###
+#
+# count the codepoints with each derived property in a range
+#
+def propertyCounts(first, last):
+    chunk = pbuf[first:last + 1]
+    return [chunk.count(chr(i)) for i in xrange(len(properties))]
+
+def addCounts(counts, more):
+    return [a + b for a, b in zip(counts, more)]
+#
+# the counts for each block and each script, as (kind, name, first, last,
+# counts) rows; first and last are None for scripts, which are scattered
+#
+def statistics():
+    total = [0] * len(properties)
+    for first, last in cpranges or [(0, 0x10FFFF)]:
+        total = addCounts(total, propertyCounts(first, last))
+    rows = []
+    covered = [0] * len(properties)
+    for start, end, data in sorted(ucd['Blocks.txt']):
+        counts = propertyCounts(start, end)
+        covered = addCounts(covered, counts)
+        rows.append(('block', data[0], start, end, counts))
+    rows.append(('block', 'No_Block', None, None, [a - b for a, b in zip(total, covered)]))
+    runs = []
+    for start, end, data in sorted(ucd['Scripts.txt']):
+        if runs and runs[-1][1] == start - 1 and runs[-1][2] == data[0]:
+            runs[-1][1] = end
+        else:
+            runs.append([start, end, data[0]])
+    scripts = {}
+    for start, end, script in runs:
+        scripts[script] = addCounts(scripts.get(script, [0] * len(properties)), propertyCounts(start, end))
+    covered = [0] * len(properties)
+    for script in sorted(scripts):
+        covered = addCounts(covered, scripts[script])
+        rows.append(('script', script, None, None, scripts[script]))
+    rows.append(('script', 'Unknown', None, None, [a - b for a, b in zip(total, covered)]))
+    return rows
+#
+# write the statistics as CSV or JSON
+#
+def hexOrBlank(cp):
+    if cp is None:
+        return ''
+    return '{:04X}'.format(cp)
+
+def writeReport(filename):
+    rows = statistics()
+    with open(filename, 'wb') as f:
+        if filename.endswith('.json'):
+            report = collections.OrderedDict([('unicode', ucdversion), ('blocks', []), ('scripts', [])])
+            for kind, name, first, last, counts in rows:
+                row = collections.OrderedDict([('name', name)])
+                if kind == 'block' and first is not None:
+                    row['first'] = hexOrBlank(first)
+                    row['last'] = hexOrBlank(last)
+                row['total'] = sum(counts)
+                row['counts'] = collections.OrderedDict(zip(properties, counts))
+                report[kind + 's'].append(row)
+            json.dump(report, f, indent=1)
+        else:
+            writer = csv.writer(f)
+            writer.writerow(['kind', 'name', 'first', 'last', 'total'] + list(properties))
+            for kind, name, first, last, counts in rows:
+                writer.writerow([kind, name, hexOrBlank(first), hexOrBlank(last), sum(counts)] + counts)
+
+if options.report:
+    writeReport(options.report)
+endPhase('output')
+#
+### END CODE ###
+#
+
+'''
+
+###
+
+6. Enforcing PRECIS Profiles
+
+So far PrecisMaker tells us how each codepoint is handled by the two
+string classes. However, what an application actually does with a
+string (say, a username that someone types into an XMPP client) is to
+enforce a PRECIS 'profile', which adds several steps on top of the
+string class:
+
+1. Width mapping: fullwidth and halfwidth characters are mapped to their
+   'normal' equivalents.
+2. Additional mapping: for example, non-ASCII spaces become U+0020.
+3. Case mapping: uppercase characters are mapped to lowercase.
+4. Normalization: Unicode Normalization Form C or KC.
+5. Directionality: the 'Bidi Rule' from RFC 5893 for strings that
+   contain right-to-left characters.
+
+Only then do we check that every character is allowed by the string
+class the profile is built on. These are the profiles defined so far:
+
+o UsernameCaseMapped (IdentifierClass): width mapping, case mapping,
+  NFC, Bidi Rule.
+o UsernameCasePreserved (IdentifierClass): width mapping, NFC, Bidi
+  Rule.
+o OpaqueString (FreeformClass): spaces to U+0020, NFC.
+o Nickname (FreeformClass): spaces to U+0020 (also removing leading and
+  trailing spaces and collapsing runs of spaces), NFKC; case mapping is
+  applied only when comparing two nicknames.
+
+All of the mappings come from the files we've already read. A fullwidth
+or halfwidth character has a decomposition of type <wide> or <narrow>
+in UnicodeData.txt (field 5), pointing at the character it maps to:
+
+FF21;FULLWIDTH LATIN CAPITAL LETTER A;Lu;0;L;<wide> 0041;;;;N;;;;FF41;
+
+and the simple lowercase mapping is field 13 of the same line (field 12
+is the uppercase mapping and field 14 the titlecase mapping). Because a
+server enforces these profiles on every login, we don't want to look
+things up step by step for each character. Instead we combine the width
+and space mappings a profile needs into a single table when PrecisMaker
+starts, so that those steps are one pass over the string (using the
+built-in unicode.translate method).
+
+Case mapping is done by the caseMap() function, which applications can
+also use on its own; we don't want anybody calling the lower() method of
+Python's unicode type, which knows only the Unicode version that Python
+was built with rather than the one in our data files. So we keep the
+uppercase, lowercase and titlecase mappings, plus the case folding from
+CaseFolding.txt (the 'full' folding, meaning the lines with status C or
+F), in two-stage tables like the one in section 5.1. Each entry is an
+index into a list of mapped strings, with 0 meaning that the character
+maps to itself.
+Most strings have nothing to map (think of a username that is already in
+lowercase), so the caseMap() function first searches the string with a
+regular expression that matches any character with a mapping, and if
+there isn't one it returns the string untouched.
+
+The CONTEXTJ and CONTEXTO codepoints are allowed only if the contextual
+rules from RFC 5892 (Appendix A) are satisfied. Those rules need the
+Canonical_Combining_Class (field 3 of UnicodeData.txt), the Script
+property (Scripts.txt) and the Joining_Type property (ArabicShaping.txt;
+characters not listed there have a Joining_Type of T if they are Mn, Me
+or Cf, and U otherwise).
+
+The Bidi Rule needs the Bidi_Class, which is field 4 of UnicodeData.txt.
+We keep it in a two-stage table just like the one in section 5.1. The
+rule applies only to strings that contain right-to-left characters (that
+is, characters whose Bidi_Class is R, AL or AN), and most strings don't
+contain any. So before we look at the classes one by one, we search the
+string with a regular expression that matches any such character, which
+costs next to nothing; only if it finds one do we check all six
+conditions of the rule, in a single pass over the string.
+
+Normalization is the most expensive step, and most of the strings we see
+are already normalized. DerivedNormalizationProps.txt gives each
+codepoint a 'quick check' value for each normalization form (NFC_QC and
+NFKC_QC): Y means the codepoint can appear in a normalized string, N
+means it can't, and M means 'maybe', depending on what comes before it.
+With those values (kept in two-stage tables) and the
+Canonical_Combining_Class, the quickCheck() function from Unicode
+Standard Annex #15 goes through the string once and answers YES, NO or
+MAYBE; only when the answer isn't YES do we actually normalize, using
+the normalize() function from section 3.15, so that both the quick check
+and the normalization itself match the files we were given.
+
+The enforce() function applies a profile to a string and returns the
+result, or raises ValueError (naming the offending character) if the
+string is not allowed. The compare() function tells you whether two
+strings are equivalent under a profile. You can also try a profile from
+the command line:
+
+--enforce UsernameCaseMapped "Juliet"
+
+'''
+
+#
+### BEGIN CODE ###
+#
+# the individual mapping tables, keyed by codepoint
+#
+widthmap = {}
+spacemap = {}
+for start, end, data in ucd['UnicodeData.txt']:
+    if data[5].startswith('<wide>') or data[5].startswith('<narrow>'):
+        widthmap[start] = cpChar(int(data[5].split()[1], 16))
+    if data[2] == 'Zs' and start != 0x0020:
+        spacemap[start] = u' '
+#
+# a regular expression character class matching the given ranges of
+# codepoints; with no ranges at all it matches nothing (on a narrow build,
+# where a regular expression sees surrogates rather than characters
+# outside the BMP, any surrogate matches if any of those characters would)
+#
+def charClass(ranges):
+    if sys.maxunicode <= 0xFFFF:
+        if any(last > 0xFFFF for first, last in ranges):
+            ranges = [(first, min(last, 0xFFFF)) for first, last in ranges if first <= 0xFFFF] + [(0xD800, 0xDFFF)]
+            ranges = bitRanges(union(*[rangeBits(first, last) for first, last in ranges]))
+    if not ranges:
+        return u'[^\\s\\S]'
+    return u'[' + u''.join(re.escape(cpChar(first)) + u'-' + re.escape(cpChar(last))
+                           for first, last in ranges) + u']'
+#
+# the case mappings, keyed by codepoint and as two-stage tables of indexes
+# into casestrings; the bits of casemask record which kinds of mapping
+# each codepoint has, so that we can find the ranges of mapped codepoints
+# (see section 4.2)
+#
+casekinds = ('upper', 'lower', 'title', 'fold')
+casemaps = dict((kind, {}) for kind in casekinds)
+casestrings = [u'']
+casestringindex = {u'': 0}
+
+def setCaseMapping(kind, cp, mapped):
+    if mapped not in casestringindex:
+        casestringindex[mapped] = len(casestrings)
+        casestrings.append(mapped)
+    casemaps[kind][cp] = mapped
+    casebufs[kind][cp] = casestringindex[mapped]
+    casemask[cp] |= 1 << casekinds.index(kind)
+
+if fulltables:
+    casebufs = dict((kind, array.array('H', [0]) * 0x110000) for kind in casekinds)
+    casemask = bytearray(0x110000)
+    for start, end, data in ucd['UnicodeData.txt']:
+        for kind, field in (('upper', 12), ('lower', 13), ('title', 14)):
+            if data[field].strip():
+                setCaseMapping(kind, start, cpChar(int(data[field], 16)))
+    for cp, mapped in foldmap.iteritems():
+        setCaseMapping('fold', cp, mapped)
+
+    casetables = dict((kind, compactTable(casebufs[kind])) for kind in casekinds)
+    casechars = dict((kind, re.compile(charClass(bitRanges(bufferBits(casemask, [code for code in xrange(16) if code & (1 << i)]))) + u'+'))
+                     for i, kind in enumerate(casekinds))
+    del casebufs, casemask
+#
+# map the case of a string ('upper', 'lower', 'title' or 'fold'), touching
+# only the runs of characters that have a mapping
+#
+def caseMap(s, kind='lower'):
+    table = casetables[kind]
+    if not casechars[kind].search(s):
+        return s
+    return casechars[kind].sub(lambda m: u''.join(casestrings[compactLookup(table, cp)] or cpChar(cp)
+                                                  for cp in codepoints(m.group())), s)
+#
+# combine several mapping tables (applied in order) into one table that
+# unicode.translate can apply in a single pass
+#
+def mappingTable(*maps):
+    table = {}
+    for cp in set().union(*maps):
+        mapped = cpChar(cp)
+        for m in maps:
+            mapped = u''.join(m.get(cp) or cpChar(cp) for cp in codepoints(mapped))
+        table[cp] = mapped
+    return table
+#
+# the profiles (the rules under 'comparison' replace the others when two
+# strings are being compared)
+#
+profiles = {
+    'UsernameCaseMapped': {
+        'stringclass': 'IdentifierClass',
+        'mapping': mappingTable(widthmap),
+        'casemapping': 'lower',
+        'normalization': 'NFC',
+        'directionality': True,
+    },
+    'UsernameCasePreserved': {
+        'stringclass': 'IdentifierClass',
+        'mapping': mappingTable(widthmap),
+        'normalization': 'NFC',
+        'directionality': True,
+    },
+    'OpaqueString': {
+        'stringclass': 'FreeformClass',
+        'mapping': mappingTable(spacemap),
+        'normalization': 'NFC',
+        'directionality': False,
+    },
+    'Nickname': {
+        'stringclass': 'FreeformClass',
+        'mapping': mappingTable(spacemap),
+        'comparison': {'casemapping': 'lower'},
+        'trimspaces': True,
+        'normalization': 'NFKC',
+        'directionality': False,
+    },
+}
+#
+# the rules of a profile, either for enforcing or for comparing
+#
+def profileRules(profile, comparison=False):
+    if profile not in profiles:
+        raise ValueError('unknown profile {!r} (try one of {})'.format(profile, ', '.join(sorted(profiles))))
+    rules = profiles[profile]
+    if comparison and 'comparison' in rules:
+        rules = dict(rules, **rules['comparison'])
+    return rules
+#
+# all of the mappings of a profile's rules combined into one table, keyed
+# by codepoint, for applications that can't call caseMap() themselves
+#
+def profileMapping(rules):
+    table = dict(rules['mapping'])
+    kind = rules.get('casemapping')
+    if kind:
+        for cp in set(table) | set(casemaps[kind]):
+            table[cp] = caseMap(cpChar(cp).translate(rules['mapping']), kind)
+    return table
+endPhase('profiles')
+#
+# the derived properties allowed by each string class (in addition to
+# CONTEXTJ and CONTEXTO, which depend on the contextual rules)
+#
+stringclasses = {
+    'IdentifierClass': ('PVALID',),
+    'FreeformClass': ('PVALID', 'FREE_PVAL'),
+}
+#
+# the properties the contextual rules need
+#
+def combiningClass(cp):
+    if cp in udict:
+        return int(udict[cp][3])
+    return 0
+
+scriptranges = sorted((start, end, data[0]) for start, end, data in ucd['Scripts.txt'])
+scriptstarts = [start for start, end, script in scriptranges]
+
+def scriptOf(cp):
+    i = bisect.bisect_right(scriptstarts, cp) - 1
+    if i >= 0 and cp <= scriptranges[i][1]:
+        return scriptranges[i][2]
+    return 'Unknown'
+
+joiningtypes = {}
+for start, end, data in ucd['ArabicShaping.txt']:
+    for cp in xrange(start, end + 1):
+        joiningtypes[cp] = data[1]
+
+def joiningType(cp):
+    if cp in joiningtypes:
+        return joiningtypes[cp]
+    if cp in udict and udict[cp][2] in ('Mn', 'Me', 'Cf'):
+        return 'T'
+    return 'U'
+#
+# the contextual rules from RFC 5892, Appendix A, for the character at
+# position i in the string s (counting characters, as firstDisallowed()
+# does)
+#
+def contextRule(s, i):
+    cps = codepoints(s)
+    cp = cps[i]
+    before = None
+    after = None
+    if i > 0:
+        before = cps[i - 1]
+    if i + 1 < len(cps):
+        after = cps[i + 1]
+    if cp == 0x200C:
+        # ZERO WIDTH NON-JOINER
+        if before is not None and combiningClass(before) == 9:
+            return True
+        j = i - 1
+        while j >= 0 and joiningType(cps[j]) == 'T':
+            j -= 1
+        if j < 0 or joiningType(cps[j]) not in ('L', 'D'):
+            return False
+        j = i + 1
+        while j < len(cps) and joiningType(cps[j]) == 'T':
+            j += 1
+        return j < len(cps) and joiningType(cps[j]) in ('R', 'D')
+    elif cp == 0x200D:
+        # ZERO WIDTH JOINER
+        return before is not None and combiningClass(before) == 9
+    elif cp == 0x00B7:
+        # MIDDLE DOT
+        return before == 0x006C and after == 0x006C
+    elif cp == 0x0375:
+        # GREEK LOWER NUMERAL SIGN (KERAIA)
+        return after is not None and scriptOf(after) == 'Greek'
+    elif cp in (0x05F3, 0x05F4):
+        # HEBREW PUNCTUATION GERESH and GERSHAYIM
+        return before is not None and scriptOf(before) == 'Hebrew'
+    elif cp == 0x30FB:
+        # KATAKANA MIDDLE DOT
+        for other in cps:
+            if other != 0x30FB and scriptOf(other) in ('Hiragana', 'Katakana', 'Han'):
+                return True
+        return False
+    elif 0x0660 <= cp <= 0x0669:
+        # ARABIC-INDIC DIGITS
+        return not any(0x06F0 <= other <= 0x06F9 for other in cps)
+    elif 0x06F0 <= cp <= 0x06F9:
+        # EXTENDED ARABIC-INDIC DIGITS
+        return not any(0x0660 <= other <= 0x0669 for other in cps)
+    return False
+#
+# find the first character in a string that the string class doesn't
+# allow, or return None if they're all allowed (the position counts
+# characters, so a surrogate pair on a narrow build counts as one)
+#
+def firstDisallowed(stringclass, s):
+    allowed = stringclasses[stringclass]
+    cps = codepoints(s)
+    for i, cp in enumerate(cps):
+        prop = properties[pbuf[cp]]
+        if prop in ('CONTEXTJ', 'CONTEXTO'):
+            if not contextRule(s, i):
+                return i
+        elif prop not in allowed:
+            return i
+    return None
+#
+# the Bidi_Class of each codepoint, as a two-stage table (see section 5.1);
+# unassigned codepoints are given the class L
+#
+bidinames = ['L'] + sorted(set(data[4] for start, end, data in ucd['UnicodeData.txt']) - set(['L']))
+bidiindex = dict((bc, i) for i, bc in enumerate(bidinames))
+
+def bidiClass(cp):
+    return bidinames[compactLookup(biditable, cp)]
+
+if fulltables:
+    bidibuf = bytearray(0x110000)
+    for start, end, data in ucd['UnicodeData.txt']:
+        bidibuf[start:end + 1] = bytearray([bidiindex[data[4]]]) * (end - start + 1)
+    biditable = compactTable(bidibuf)
+    #
+    # a regular expression that finds any R, AL or AN character, built from
+    # the ranges of codepoints with those classes (see section 4.2)
+    #
+    rtlranges = bitRanges(bufferBits(bidibuf, [bidiindex[bc] for bc in ('R', 'AL', 'AN') if bc in bidiindex]))
+    rtlchars = re.compile(charClass(rtlranges))
+    del bidibuf
+#
+# the Bidi Rule from RFC 5893, which applies only to strings that contain
+# right-to-left characters; we check all six conditions in one pass
+#
+def bidiRule(s):
+    if not rtlchars.search(s):
+        return True
+    cps = codepoints(s)
+    first = bidiClass(cps[0])
+    if first in ('R', 'AL'):
+        allowed = ('R', 'AL', 'AN', 'EN', 'ES', 'CS', 'ET', 'ON', 'BN', 'NSM')
+        endings = ('R', 'AL', 'EN', 'AN')
+    elif first == 'L':
+        allowed = ('L', 'EN', 'ES', 'CS', 'ET', 'ON', 'BN', 'NSM')
+        endings = ('L', 'EN')
+    else:
+        return False
+    seen = set()
+    last = first
+    for cp in cps:
+        bc = bidiClass(cp)
+        if bc not in allowed:
+            return False
+        seen.add(bc)
+        if bc != 'NSM':
+            last = bc
+    if last not in endings:
+        return False
+    return not ('EN' in seen and 'AN' in seen)
+endPhase('bidi')
+#
+# the NFC_QC and NFKC_QC properties of each codepoint, as two-stage tables
+# (YES comes first, since it's the value for any codepoint that isn't
+# listed)
+#
+qcvalues = ('YES', 'NO', 'MAYBE')
+if fulltables:
+    qcbufs = {'NFC': bytearray(0x110000), 'NFKC': bytearray(0x110000)}
+    for start, end, data in ucd['DerivedNormalizationProps.txt']:
+        if data[0] in ('NFC_QC', 'NFKC_QC'):
+            qcbufs[data[0][:-3]][start:end + 1] = bytearray([{'N': 1, 'M': 2}[data[1]]]) * (end - start + 1)
+    qctables = dict((form, compactTable(qcbufs[form])) for form in qcbufs)
+    #
+    # a regular expression that finds any character that could make the quick
+    # check say anything but YES: one that isn't YES itself, or one with a
+    # nonzero combining class (which might be out of order)
+    #
+    qcchars = dict((form, re.compile(charClass(bitRanges(union(bufferBits(qcbufs[form], (1, 2)),
+                                                               bufferBits(cccbuf, xrange(1, 256)))))))
+                   for form in qcbufs)
+    del qcbufs
+#
+# the quick check from UAX #15, returning 'YES', 'NO' or 'MAYBE'
+#
+def quickCheck(form, s):
+    if not qcchars[form].search(s):
+        return 'YES'
+    table = qctables[form]
+    result = 'YES'
+    last = 0
+    for cp in codepoints(s):
+        ccc = cccbuf[cp]
+        if last > ccc and ccc != 0:
+            return 'NO'
+        qc = compactLookup(table, cp)
+        if qc == 1:
+            return 'NO'
+        if qc == 2:
+            result = 'MAYBE'
+        last = ccc
+    return result
+endPhase('normalization')
+#
+# enforce a profile on a string, returning the result or raising ValueError
+#
+def enforce(profile, s, comparison=False):
+    if missingFiles('the PRECIS profiles'):
+        raise RuntimeError('the PRECIS profiles need ' + ', '.join(missingFiles('the PRECIS profiles')))
+    if isinstance(s, str):
+        # a byte string is taken to be UTF-8 (a UnicodeDecodeError is a
+        # ValueError, so undecodable input is rejected like any other)
+        s = s.decode('utf-8')
+    rules = profileRules(profile, comparison)
+    s = s.translate(rules['mapping'])
+    if rules.get('casemapping'):
+        s = caseMap(s, rules['casemapping'])
+    if rules.get('trimspaces'):
+        s = u' '.join(word for word in s.split(u' ') if word)
+    if quickCheck(rules['normalization'], s) != 'YES':
+        s = normalize(rules['normalization'], s)
+    if not s:
+        raise ValueError(profile + ' does not allow empty strings')
+    if rules['directionality'] and not bidiRule(s):
+        raise ValueError(profile + ' requires strings to satisfy the Bidi Rule')
+    i = firstDisallowed(rules['stringclass'], s)
+    if i is not None:
+        raise ValueError(profile + ' does not allow ' + explain(codepoints(s)[i]))
+    return s
+#
+# determine if two strings are equivalent under a profile
+#
+def compare(profile, s1, s2):
+    return enforce(profile, s1, True) == enforce(profile, s2, True)
+
+if options.enforce:
+    profile, text = options.enforce
+    if profile not in profiles:
+        parser.error('unknown profile {} (try one of {})'.format(profile, ', '.join(sorted(profiles))))
+    try:
+        print enforce(profile, text).encode('utf-8')
+    except ValueError, e:
+        sys.stderr.write(str(e) + '\n')
+        sys.exit(1)
+#
+### END CODE ###
+#
+
+'''
+
+6.1 Caching Enforcement Results
+
+On a busy XMPP server the same strings (popular usernames, the names of
+other servers) are enforced over and over again. The cachedEnforce(),
+cachedCompare() and cachedFirstDisallowed() functions put a cache in
+front of enforce(), compare() and firstDisallowed(): the results are
+remembered by function, profile (or string class) and input, and when
+the cache is full we throw away whichever entry was used least recently.
+Strings that are rejected are remembered too, and raise the same
+ValueError the next time around.
+
+Because a server might answer requests from several threads at once,
+the cache is protected by a lock. The setCacheSize() function sets the
+maximum number of entries (10000 unless you say otherwise), and the
+cacheStats() function reports the number of hits, misses and evictions
+so far, for whatever metrics system you happen to use. (The tables never
+change once PrecisMaker has built them, so a cached result never goes
+stale.)
+
+'''
+
+#
+### BEGIN CODE ###
+#
+# the cache itself, its size limit and its counters
+#
+cache = collections.OrderedDict()
+cachelock = threading.Lock()
+cachesize = 10000
+cachestats = {'hits': 0, 'misses': 0, 'evictions': 0}
+#
+# change the maximum size of the cache, evicting entries if need be
+#
+def setCacheSize(size):
+    global cachesize
+    with cachelock:
+        cachesize = size
+        while len(cache) > cachesize:
+            cache.popitem(last=False)
+            cachestats['evictions'] += 1
+#
+# report the cache counters
+#
+def cacheStats():
+    with cachelock:
+        stats = dict(cachestats)
+        stats['size'] = len(cache)
+        stats['maxsize'] = cachesize
+    return stats
+#
+# wrap a function so that its results (and ValueErrors) are cached
+#
+def cached(func):
+    def wrapper(*args):
+        key = (func.__name__,) + args
+        with cachelock:
+            if key in cache:
+                # move the entry to the most recently used end
+                result = cache.pop(key)
+                cache[key] = result
+                cachestats['hits'] += 1
+            else:
+                result = None
+                cachestats['misses'] += 1
+        if result is None:
+            try:
+                result = (True, func(*args))
+            except ValueError, e:
+                result = (False, str(e))
+            with cachelock:
+                if cachesize > 0 and key not in cache:
+                    cache[key] = result
+                    while len(cache) > cachesize:
+                        cache.popitem(last=False)
+                        cachestats['evictions'] += 1
+        if not result[0]:
+            raise ValueError(result[1])
+        return result[1]
+    return wrapper
+
+cachedEnforce = cached(enforce)
+cachedCompare = cached(compare)
+cachedFirstDisallowed = cached(firstDisallowed)
+#
+### END CODE ###
+#
+
+'''
+
+6.2 Sharing the Tables Between Processes
+
+A big XMPP deployment runs many worker processes on each host, and if
+every one of them imported PrecisMaker it would spend a few seconds
+building its own copy of the very same tables. Instead, one process can
+run PrecisMaker with the --publish option, which writes the derived
+property and the rule for each codepoint (one byte each, exactly as in
+the compact buffers of section 4) along with the mapping tables of each
+profile to a single file:
+
+--publish /dev/shm/precis-tables
+
+The workers then use the SharedTables class from the standalone module
+of section 5.1 to attach to that file. SharedTables maps the file into
+memory read-only and reads each entry straight out of the mapped pages,
+so attaching costs next to nothing, nothing is copied, and however many
+workers there are, the host keeps only one copy of the tables (put the
+file on a RAM-backed filesystem such as /dev/shm and there's no disk
+involved at all).
+
+The file starts with eight bytes that identify it, followed by the
+length of a JSON header and the header itself, which gives the Unicode
+version, the names of the properties and the rules, and the offset,
+length and type of each of the tables that follow. Each mapping table
+is a two-stage table (see section 5.1) of indexes into a shared list of
+mapped strings, stored as UTF-8 along with their offsets. All numbers
+are little-endian. We write the file under a temporary name and then
+rename it, so a worker never sees a half-written file.
+
+'''
+
+#
+### BEGIN CODE ###
+#
+# publish the tables in a file that worker processes can map into memory
+#
+def publishTables(filename):
+    tables = collections.OrderedDict()
+    tables['properties'] = pbuf
+    tables['reasons'] = rbuf
+    strings = [u'']
+    stringindex = {u'': 0}
+    for profile in sorted(profiles):
+        for key in ('mapping', 'comparison'):
+            if key not in profiles[profile]:
+                continue
+            buf = array.array('H', [0]) * 0x110000
+            for cp, mapped in profileMapping(profileRules(profile, key == 'comparison')).iteritems():
+                if mapped not in stringindex:
+                    stringindex[mapped] = len(strings)
+                    strings.append(mapped)
+                buf[cp] = stringindex[mapped]
+            shift, stage1, stage2 = compactTable(buf)
+            tables[profile + '.' + key + '.stage1'] = stage1
+            tables[profile + '.' + key + '.stage2'] = stage2
+    data = bytearray()
+    offsets = array.array('I', [0])
+    for mapped in strings:
+        data += mapped.encode('utf-8')
+        offsets.append(len(data))
+    tables['strings.offsets'] = offsets
+    tables['strings.data'] = data
+    # work out where each table goes, 8-byte aligned, after the header;
+    # the header holds the offsets, so repeat until its length settles
+    sections = collections.OrderedDict()
+    header = ''
+    start = 0
+    while True:
+        offset = start
+        for name, table in tables.iteritems():
+            typecode = getattr(table, 'typecode', 'B')
+            sections[name] = (offset, len(table), typecode)
+            offset += (len(table) * getattr(table, 'itemsize', 1) + 7) & ~7
+        header = json.dumps({
+            'unicode': ucdversion,
+            'properties': properties,
+            'reasons': reasons,
+            'shift': shift,
+            'sections': sections,
+        })
+        if start == (12 + len(header) + 7) & ~7:
+            break
+        start = (12 + len(header) + 7) & ~7
+    temporary = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.write('PRECIS\x00\x01')
+        f.write(arrayBytes(array.array('I', [len(header)])))
+        f.write(header)
+        for name, table in tables.iteritems():
+            f.seek(sections[name][0])
+            if isinstance(table, bytearray):
+                f.write(table)
+            else:
+                f.write(arrayBytes(table))
+    os.rename(temporary, filename)
+
+if options.publish:
+    publishTables(options.publish)
+endPhase('publish')
+#
+### END CODE ###
+#
+
+'''
+
+###
+
+7. Checking for Regressions
+
+Whenever PrecisMaker itself changes, we want to know two things: did the
+change alter the derived property of any codepoint, and did it make the
+run slower or hungrier? The --golden option answers both questions.
+
+For the first question, we compare the derived properties we just
+computed against a 'golden' table that we trust. That table can be the
+output of an earlier run (see --write-ranges in section 5.2) or the XML
+produced by the createtables script, which section 5 says we ought to
+match. (The createtables XML writes "ID_DIS or FREE_PVAL" where we write
+simply FREE_PVAL.) Any codepoint whose property differs is reported,
+together with the rule that decided its new property. A value that we
+don't recognize in the golden table (SAFE_DIS, say, from an older draft)
+counts as drift for every codepoint it covers. If we were asked to
+classify only some ranges of codepoints, we compare only those.
+
+For the second question, we append the time each phase took and the
+peak memory use of the process to a little JSON history file (see the
+--history option) and compare this run with the last few runs for the
+same version of Unicode that did the same work: the same --range and
+--plane options, the same --jobs, and the same options that add work of
+their own (such as --report or --selftest). If a phase took more than
+the --threshold fraction longer than usual (by default 25%), or we used
+that much more memory, we say so. Phases that take only a fraction of a second are too
+noisy to judge, so we ignore differences of less than a tenth of a
+second.
+
+If either kind of regression shows up, PrecisMaker exits with a non-zero
+status, so that the check can serve as a gate in a build.
+
+'''
+
+#
+### BEGIN CODE ###
+#
+# read a golden table (range-collapsed text or createtables XML) into a
+# buffer of derived properties, along with the names of the values in it;
+# a value we don't know (such as an older name for one of the properties)
+# gets a code of its own after ours, so that it shows up as drift
+#
+def readGolden(filename):
+    golden = bytearray(0x110000)
+    names = list(properties)
+    with open(filename) as f:
+        text = f.read()
+    if text.lstrip().startswith('<'):
+        records = []
+        for match in re.finditer(r'<codepoint>\s*([^<]*?)\s*</codepoint>\s*<property>\s*([^<]*?)\s*</property>', text):
+            cps = re.split(r'\.\.|-', match.group(1))
+            records.append((int(cps[0], 16), int(cps[-1], 16), [match.group(2)]))
+    else:
+        records = parsePropertyFile(filename)
+    for first, last, data in records:
+        prop = data[0]
+        if 'FREE_PVAL' in prop:
+            prop = 'FREE_PVAL'
+        if prop not in names:
+            if len(names) == 256:
+                sys.exit('{}: too many unknown property values'.format(filename))
+            names.append(prop)
+        golden[first:last + 1] = bytearray([names.index(prop)]) * (last - first + 1)
+    return golden, names
+#
+# find the codepoints whose derived property differs from the golden table,
+# skipping quickly over the blocks that are identical
+#
+def goldenDrift(golden, blocksize=4096):
+    drift = []
+    for first, last in cpranges or [(0, 0x10FFFF)]:
+        for start in xrange(first, last + 1, blocksize):
+            end = min(start + blocksize, last + 1)
+            if golden[start:end] == pbuf[start:end]:
+                continue
+            for cp in xrange(start, end):
+                if golden[cp] != pbuf[cp]:
+                    drift.append(cp)
+    return drift
+#
+# report the drift, collapsing runs of codepoints that changed in the same way
+#
+def reportDrift(golden, names, drift):
+    runs = []
+    for cp in drift:
+        change = (golden[cp], pbuf[cp], rbuf[cp])
+        if runs and runs[-1][1] == cp - 1 and runs[-1][2] == change:
+            runs[-1][1] = cp
+        else:
+            runs.append([cp, cp, change])
+    for first, last, (old, new, reason) in runs:
+        if first == last:
+            cps = 'U+{:04X}'.format(first)
+        else:
+            cps = 'U+{:04X}..U+{:04X}'.format(first, last)
+        sys.stderr.write('{} was {}, now {} ({})\n'.format(cps, names[old], properties[new], reasons[reason]))
+#
+# the peak memory use of this process, in kilobytes
+#
+def peakMemory():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # macOS reports bytes rather than kilobytes
+        peak //= 1024
+    return peak
+#
+# what this run did, beyond the checks: the ranges it classified and the
+# options that add work of their own (two runs are comparable only if
+# these match)
+#
+workoptions = ('verify', 'selftest', 'explain', 'query', 'enforce', 'generate_module',
+               'publish', 'write_ranges', 'write_idna_ranges', 'report')
+
+def runKind():
+    return {
+        'ranges': ['{:04X}..{:04X}'.format(first, last) for first, last in cpranges or []],
+        'options': sorted(option for option in workoptions if getattr(options, option)),
+        'jobs': options.jobs,
+    }
+#
+# compare this run with the last few runs of the same kind, for the same
+# version of Unicode
+#
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def performanceRegressions(entry, history, threshold, runs=5):
+    earlier = [h for h in history if h['unicode'] == entry['unicode'] and h.get('run') == entry['run']][-runs:]
+    problems = []
+    for name, seconds in entry['timings'].items():
+        usual = [h['timings'][name] for h in earlier if name in h['timings']]
+        if usual and seconds > median(usual) * (1 + threshold) and seconds - median(usual) >= 0.1:
+            problems.append('{} took {:.2f}s, usually {:.2f}s'.format(name, seconds, median(usual)))
+    usual = [h['peakmemory'] for h in earlier if h.get('peakmemory')]
+    if usual and entry['peakmemory'] and entry['peakmemory'] > median(usual) * (1 + threshold):
+        problems.append('peak memory was {} KB, usually {} KB'.format(entry['peakmemory'], median(usual)))
+    return problems
+#
+# run the checks and record this run in the history file
+#
+if options.golden:
+    golden, goldennames = readGolden(options.golden)
+    drift = goldenDrift(golden)
+    reportDrift(golden, goldennames, drift)
+    history = []
+    if os.path.exists(options.history):
+        with open(options.history) as f:
+            history = json.load(f)
+    entry = {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'unicode': ucdversion,
+        'run': runKind(),
+        'timings': timings,
+        'peakmemory': peakMemory(),
+        'drift': len(drift),
+    }
+    problems = performanceRegressions(entry, history, options.threshold)
+    for problem in problems:
+        sys.stderr.write(problem + '\n')
+    history.append(entry)
+    with open(options.history, 'w') as f:
+        json.dump(history, f, indent=1)
+    if drift or problems:
+        sys.exit(1)
+#
+### END CODE ###
+#
+
+'''
+
 ###
 
-6. Acknowledgements
+8. Acknowledgements
 
 I would like to thank the following people for their assistance:
 
@@ -993,7 +3162,7 @@ I would like to thank the following people for their assistance:
 
 ###
 
-7. License
+9. License
 
 This is free and unencumbered software released into the public domain.
 